@@ -6,34 +6,81 @@
 #
 # Warning: work in progress!
 
-import fileinput
+import argparse
+import collections
+import concurrent.futures
+import functools
+import io
+import os
 import re
 import sys
 import subprocess
-from enum import Enum
+from enum import IntEnum
+
+# Report every matched trace line while parsing
+DEBUG = False
+# Keep the size of every call in the summary, not only the totals
+KEEP_HISTORY = False
 
 symbol_resolve_cmd = 'c++filt'
 symbols_map = {}
 
+# Minimum number of symbols worth starting another c++filt for
+SYMBOLS_PER_JOB = 1000
+
+# Symbols are collected unresolved while parsing and demangled in batches by
+# start_resolve_all(), c++filt reads one symbol per line on stdin
+def register_symbol(symbol):
+    symbols_map.setdefault(symbol, None)
+
+# Runs in a worker thread, returns None if c++filt failed
+def demangle(symbols):
+    p = subprocess.Popen([symbol_resolve_cmd], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    # Terminate every symbol, an empty last one would be lost by a join
+    out, _ = p.communicate(''.join(s + '\n' for s in symbols).encode(sys.stdout.encoding))
+    if p.returncode != 0:
+        return None
+    return out.decode(sys.stdout.encoding).splitlines()
+
+# Split the unresolved symbols across parallel c++filt runs, the work is
+# done by the child processes so threads are enough to drive them.
+# Returns the pending batches for finish_resolve_all()
+def start_resolve_all(executor):
+    symbols = [s for s, v in symbols_map.items() if v is None]
+    jobs = min(os.cpu_count() or 1, -(-len(symbols) // SYMBOLS_PER_JOB))
+    batches = [symbols[i::jobs] for i in range(jobs)]
+    return [(batch, executor.submit(demangle, batch)) for batch in batches]
+
+def finish_resolve_all(pending):
+    for batch, future in pending:
+        resolved = future.result()
+        if resolved is None:
+            error('Failed to run {0}'.format(symbol_resolve_cmd))
+        assert(len(resolved) == len(batch))
+        symbols_map.update(zip(batch, resolved))
+
 def resolve_symbol(symbol):
-    if not symbol in symbols_map:
-        symbols_map[symbol] = subprocess.check_output([symbol_resolve_cmd, symbol]) \
-                .decode(sys.stdout.encoding).rstrip()
     return symbols_map[symbol]
 
 # line format (PATH can include +):
 # PATH(SYMBOL+OFFSET)[ADDRESS]
 class BacktraceLine:
+    __slots__ = ('path', 'symbol', 'offset', 'address')
+
     def __init__(self, line):
-        fields = re.split('\(|\)|\[|\]', line)
-        assert(len(fields) == 5)
-        symfields = fields[1].split('+')
-        assert(len(symfields) == 2)
+        # Split from the right as only PATH can contain the separators
+        head, sep, address = line.rpartition('[')
+        assert(sep and address.endswith(']'))
+        head, sep, offset = head.rpartition('+')
+        assert(sep and offset.endswith(')'))
+        path, sep, symbol = head.rpartition('(')
+        assert(sep)
 
-        self.path = fields[0]
-        self.symbol = symfields[0]
-        self.offset = symfields[1]
-        self.address = fields[3]
+        self.path = path
+        # Kept in symbols_map, shared by many frames
+        self.symbol = sys.intern(symbol)
+        self.offset = offset[:-1]
+        self.address = address[:-1]
 
     # TODO: a range could be useful for offset and address
     def match(self, pattern):
@@ -54,16 +101,29 @@ class BacktraceLine:
 # TODO: filters could be extended
 backtrace_filter_out=BacktraceLine('libmtrace.so(+)[]')
 
+# The same frames repeat across most backtraces, only parse each one once.
+# Returns None for filtered out frames, otherwise the raw frame is kept and
+# its symbol is resolved for the summary
+@functools.lru_cache(maxsize=None)
+def process_backtrace_line(line):
+    bt = BacktraceLine(line)
+    if bt.match(backtrace_filter_out):
+        return None
+    register_symbol(bt.symbol)
+    return sys.intern(line)
+
 def error(line):
     print(line)
     sys.exit(1)
 
-def printHeader(s):
+def formatHeader(s):
     n=len(s)
-    l='#'*(n+2)
-    print("{0}\n# {1}\n{0}\n".format('#'*(n+2), s))
+    return "{0}\n# {1}\n{0}\n\n".format('#'*(n+2), s)
+
+def printHeader(s):
+    sys.stdout.write(formatHeader(s))
 
-class ParsingStatus(Enum):
+class ParsingStatus(IntEnum):
     READY=0
     THREAD=1
     METHOD=2
@@ -71,159 +131,316 @@ class ParsingStatus(Enum):
     BACKTRACE=4
     BACKTRACE_END=5
 
-backtraces = {}
+METHODS = ('malloc', 'free', 'realloc', 'calloc', 'aligned_alloc',
+        'posix_memalign', 'memalign')
+
+# Sizes are kept as ints, negative values report why a size is not known
+SIZE_NULL = -1          # free(NULL)
+SIZE_UNKNOWN = -2       # pointer not allocated in the trace
+SIZE_FREED = -3         # pointer already freed
+SIZE_REALLOCED = -4     # pointer already moved by realloc
+
+size_names = {
+    SIZE_NULL: 'null',
+    SIZE_UNKNOWN: '???',
+    SIZE_FREED: '***ALREADY_FREED**',
+    SIZE_REALLOCED: '***ALREADY_REALLOCED***',
+}
+
+# How calls without a known size are counted in the summary
+size_descriptions = {
+    SIZE_NULL: 'null',
+    SIZE_UNKNOWN: 'unknown',
+    SIZE_FREED: 'already freed',
+    SIZE_REALLOCED: 'already reallocated',
+}
+
+def format_size(size):
+    return size_names.get(size, str(size))
+
+def format_sizes(sizes):
+    return '[{0}]'.format(', '.join(format_size(size) for size in sizes))
+
+# Running totals of one method for a backtrace, calls without a known size
+# are counted per reason. The size of every call is only kept with
+# KEEP_HISTORY
+class MethodStats:
+    __slots__ = ('calls', 'total', 'unsized', 'sizes')
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0
+        self.unsized = None
+        self.sizes = list() if KEEP_HISTORY else None
+
+    def add(self, size):
+        self.calls += 1
+        if size >= 0:
+            self.total += size
+        else:
+            if self.unsized is None:
+                self.unsized = collections.Counter()
+            self.unsized[size] += 1
+        if self.sizes is not None:
+            self.sizes.append(size)
+
+    def toString(self):
+        s = '{0} calls, {1} bytes'.format(self.calls, self.total)
+        if self.unsized is not None:
+            for size, description in size_descriptions.items():
+                if size in self.unsized:
+                    s += ', {0} {1}'.format(self.unsized[size], description)
+        if self.sizes is not None:
+            s += ' ' + format_sizes(self.sizes)
+        return s
+
+def new_stats():
+    stats = {'count': 0}
+    for method in METHODS:
+        stats[method] = MethodStats()
+    return stats
+
+backtraces = collections.defaultdict(new_stats)
 mallocs = {}
 membt = {}
 
-def parse():
+# Handlers update the allocation state and return the size to account for
+def record_malloc(size, address):
+    allocSize = int(size)
+    if DEBUG:
+        print("matched malloc {0} {1}".format(size, address))
+    mallocs[address] = allocSize
+    return allocSize
+
+def record_free(ptr):
+    if ptr == '(nil)':
+        allocSize = SIZE_NULL
+    elif ptr in mallocs:
+        allocSize = mallocs[ptr]
+    else:
+        allocSize = SIZE_UNKNOWN
+    if DEBUG:
+        print("matched free {0}".format(ptr))
+    mallocs[ptr] = SIZE_FREED
+    if ptr in membt:
+        del membt[ptr]
+    return allocSize
+
+def record_realloc(ptr, size, address):
+    allocSize = int(size)
+    if DEBUG:
+        print("matched remalloc {0} {1}".format(ptr, size))
+    mallocs[address] = allocSize
+    if ptr != address:
+        mallocs[ptr] = SIZE_REALLOCED
+    if ptr in membt:
+        del membt[ptr]
+    return allocSize
+
+def record_calloc(nmemb, size, address):
+    allocSize = int(nmemb) * int(size)
+    if DEBUG:
+        print("matched calloc {0} {1} {2}".format(nmemb, size, address))
+    mallocs[address] = allocSize
+    return allocSize
+
+def record_aligned(method, alignment, size, address):
+    allocSize = int(size)
+    if DEBUG:
+        print("matched {0} {1} {2} {3}".format(method, alignment, size, address))
+    mallocs[address] = allocSize
+    return allocSize
+
+ALIGNED_METHODS = ('aligned_alloc', 'posix_memalign', 'memalign')
+
+# The method is always the leading token so plain string operations are
+# enough. Each parser gets the arguments following the method and returns
+# (allocSize, address), or None when they are not in the expected format
+def parse_malloc_args(args):
+    size, sep, address = args.partition(') = ')
+    if sep and size.isdecimal():
+        return record_malloc(size, address), address
+
+def parse_free_args(args):
+    if args.endswith(')'):
+        return record_free(args[:-1]), None
+
+def parse_realloc_args(args):
+    args, sep, address = args.partition(') = ')
+    ptr, comma, size = args.rpartition(', ')
+    if sep and comma and size.isdecimal():
+        return record_realloc(ptr, size, address), address
+
+def parse_calloc_args(args):
+    args, sep, address = args.partition(') = ')
+    nmemb, comma, size = args.partition(', ')
+    if sep and comma and nmemb.isdecimal() and size.isdecimal():
+        return record_calloc(nmemb, size, address), address
+
+def aligned_args_parser(method):
+    def parse_aligned_args(args):
+        args, sep, address = args.partition(') = ')
+        alignment, comma, size = args.partition(', ')
+        if sep and comma and alignment.isdecimal() and size.isdecimal():
+            return record_aligned(method, alignment, size, address), address
+    return parse_aligned_args
+
+call_parsers = {
+    'malloc': parse_malloc_args,
+    'free': parse_free_args,
+    'realloc': parse_realloc_args,
+    'calloc': parse_calloc_args,
+}
+call_parsers.update((method, aligned_args_parser(method)) for method in ALIGNED_METHODS)
+
+# Returns (method, allocSize, address) or None when the line is not in the
+# expected format
+def parse_call(line):
+    method, _, args = line.partition('(')
+    parser = call_parsers.get(method)
+    if parser is None:
+        return None
+    call = parser(args)
+    if call is None:
+        return None
+    return method, call[0], call[1]
+
+# Like fileinput, read the given files or stdin for '-'. Unless streaming
+# each input is read at once as it is much faster than line by line
+def read_lines(paths, streaming):
+    for path in paths:
+        if path == '-':
+            f = sys.stdin.buffer
+        else:
+            f = open(path, 'rb')
+        with f:
+            if streaming:
+                # Universal newlines, only a trailing '\n' can be left
+                for line in io.TextIOWrapper(f, encoding='utf-8', errors='replace'):
+                    yield line[:-1] if line.endswith('\n') else line
+            else:
+                yield from f.read().decode('utf-8', 'replace').splitlines()
+
+# In streaming mode the backtraces are not retained, instead every event is
+# written out as soon as its backtrace ends as one tab separated record:
+#   METHOD SIZE THREAD FRAME...
+# with the raw frames, to be aggregated externally e.g. sort | uniq -c
+def write_record(method, allocSize, backtrace):
+    sys.stdout.write('\t'.join([method, format_size(allocSize)] + backtrace) + '\n')
+
+def parse(paths, streaming=False):
     comments = []
-    printHeader("Parsing")
-    status = ParsingStatus.READY
+    if not streaming:
+        printHeader("Parsing")
+    # Hot loop, avoid global and attribute lookups for every line
+    READY = ParsingStatus.READY
+    THREAD = ParsingStatus.THREAD
+    BACKTRACE_START = ParsingStatus.BACKTRACE_START
+    BACKTRACE = ParsingStatus.BACKTRACE
+    process_frame = process_backtrace_line
+    status = READY
 
-    for line in fileinput.input():
-        line = line.rstrip()
-        if status == ParsingStatus.READY:
+    for line in read_lines(paths, streaming):
+        if status == READY:
             thread_id = None
             method = None
             allocSize = 0
             address = None
-            currentBackTrace = ''
-            status = ParsingStatus.THREAD
+            currentBackTrace = []
+            status = THREAD
         if len(line) == 0 or line[0] == ' ' or line[0] == '-' or line[0] == '#':
             if len(line) > 1:
-                comments.append(line)
+                if streaming:
+                    sys.stderr.write(line + '\n')
+                else:
+                    comments.append(line)
             continue
-        elif status == ParsingStatus.THREAD:
+        elif status == THREAD:
             assert(line.startswith('* '))
-            m = re.findall(r'\d+', line)
-            if len(m) < 1:
-                sys.exit(1)
-            thread_id = m[0]
-            currentBackTrace += 'Thread {0}'.format(thread_id)
-            line = line[3+len(m[0]):]
-            status = ParsingStatus.METHOD
+            thread_id, _, call_line = line[2:].partition(' ')
+            if not thread_id.isdigit():
+                error('Unexpected line {0}: '.format(line))
+            line = call_line
+            currentBackTrace.append('Thread ' + thread_id)
             #elif status == ParsingStatus.METHOD:
-            status = ParsingStatus.BACKTRACE_START
-            match = re.search(r"^malloc\((\d*)\) = (.*)$", line)
-            if match:
-                method = 'malloc'
-                allocSize = match.group(1)
-                print("matched malloc {0} {1}".format(match.group(1), match.group(2)))
-                mallocs[match.group(2)] = match.group(1)
-                address = match.group(2)
-                continue
-            match = re.search(r"^free\((.*)\)$", line)
-            if match:
-                method = 'free'
-                if match.group(1) == '(nil)':
-                    allocSize = 'null'
-                elif match.group(1) in mallocs:
-                    allocSize = mallocs[match.group(1)]
-                else:
-                    allocSize = '???'
-                print("matched free {0}".format(match.group(1)))
-                mallocs[match.group(1)] = '***ALREADY_FREED**'
-                if match.group(1) in membt:
-                    del membt[match.group(1)]
-                continue
-            match = re.search(r"^realloc\((.*), (\d*)\) = (.*)$", line)
-            if match:
-                method = 'realloc'
-                allocSize = match.group(2)
-                print("matched remalloc {0} {1}".format(match.group(1), match.group(2)))
-                mallocs[match.group(3)] = match.group(2)
-                if match.group(1) != match.group(3):
-                    mallocs[match.group(1)] = '***ALREADY_REALLOCED***'
-                if match.group(1) in membt:
-                    del membt[match.group(1)]
-                address = match.group(3)
-                continue
-            match = re.search(r"^calloc\((\d*), (\d*)\) = (.*)$", line)
-            if match:
-                method = 'calloc'
-                allocSize = int(match.group(1)) * int(match.group(2))
-                print("matched calloc {0} {1} {2}".format(match.group(1),
-                    match.group(2), match.group(3)))
-                mallocs[match.group(3)] = allocSize
-                address = match.group(3)
-                continue
-            match = re.search(r"^aligned_alloc\((\d*), (\d*)\) = (.*)$", line)
-            if match:
-                method = 'aligned_alloc'
-                allocSize = int(match.group(2))
-                print("matched aligned_alloc {0} {1} {2}".format(match.group(1),
-                    match.group(2), match.group(3)))
-                mallocs[match.group(3)] = allocSize
-                address = match.group(3)
-                continue
-            match = re.search(r"^posix_memalign\((\d*), (\d*)\) = (.*)$", line)
-            if match:
-                method = 'posix_memalign'
-                allocSize = int(match.group(2))
-                print("matched posix_memalign {0} {1} {2}".format(match.group(1),
-                    match.group(2), match.group(3)))
-                mallocs[match.group(3)] = allocSize
-                address = match.group(3)
-                continue
-            match = re.search(r"^memalign\((\d*), (\d*)\) = (.*)$", line)
-            if match:
-                method = 'memalign'
-                allocSize = int(match.group(2))
-                print("matched memalign {0} {1} {2}".format(match.group(1),
-                    match.group(2), match.group(3)))
-                mallocs[match.group(3)] = allocSize
-                address = match.group(3)
-                continue
-            error('Unexpected line {0}: '.format(line))
-        elif status == ParsingStatus.BACKTRACE_START:
+            status = BACKTRACE_START
+            call = parse_call(line)
+            if call is None:
+                error('Unexpected line {0}: '.format(line))
+            method, allocSize, address = call
+        elif status == BACKTRACE_START:
             assert(line == '[')
-            status = ParsingStatus.BACKTRACE
-        elif status == ParsingStatus.BACKTRACE:
+            status = BACKTRACE
+        elif status == BACKTRACE:
             if line == ']':
-                if not currentBackTrace in backtraces:
-                    backtraces[currentBackTrace] = {'count': 0, 'malloc': list(),
-                            'free': list(), 'realloc': list(), 'calloc': list(),
-                            'aligned_alloc': list(), 'posix_memalign': list(),
-                            'memalign': list() }
-                backtraces[currentBackTrace]['count'] += 1
-                backtraces[currentBackTrace][method].append(allocSize)
+                status = READY
+                if streaming:
+                    write_record(method, allocSize, currentBackTrace)
+                    continue
+                key = '\n'.join(currentBackTrace)
+                stats = backtraces[key]
+                stats['count'] += 1
+                stats[method].add(allocSize)
                 if address is not None:
-                    membt[address] = currentBackTrace
-                status = ParsingStatus.READY
+                    membt[address] = key
             else:
-                bt = BacktraceLine(line)
-                if bt.match(backtrace_filter_out):
+                frame = process_frame(line)
+                if frame is None:
                     continue
-                if len(currentBackTrace) > 0:
-                    currentBackTrace += '\n'
-                currentBackTrace += bt.toString()
-    print()
+                currentBackTrace.append(frame)
+    if streaming:
+        return
+    sys.stdout.write('\n' + formatHeader("Comments")
+            + ''.join(line + '\n' for line in comments) + '\n')
 
-    printHeader("Comments")
-    for line in comments:
-        print(line)
-    print()
+# Only valid after finish_resolve_all(), shared frames are formatted once
+@functools.lru_cache(maxsize=None)
+def readable_frame(line):
+    return sys.intern(BacktraceLine(line).toString())
+
+# Backtraces are stored as the thread followed by the raw frames
+def readable_backtrace(backtrace):
+    lines = backtrace.split('\n')
+    return '\n'.join([lines[0]] + [readable_frame(line) for line in lines[1:]])
+
+# Symbols are only needed once the backtraces are sorted, wait for the
+# pending batches then
+def summary(pending):
+    ordered = sorted(backtraces.items(), key=lambda item: item[1]['count'])
+    finish_resolve_all(pending)
 
-def summary():
     printHeader("Backtraces")
-    for backtrace in dict(sorted(backtraces.items(), key=lambda item: item[1]['count'])):
-        print("{0}".format(backtrace))
-        stats = backtraces[backtrace]
-        print("* Calls: {0}".format(stats['count']))
+    for backtrace, stats in ordered:
+        out = [f"{readable_backtrace(backtrace)}\n", f"* Calls: {stats['count']}\n"]
         for method in sorted(stats):
             if method == 'count':
                 continue
-            if len(stats[method]) > 0:
-                print("  {0}: {1}".format(method, stats[method]))
-        print()
+            method_stats = stats[method]
+            if method_stats.calls > 0:
+                out.append(f"  {method}: {method_stats.toString()}\n")
+        out.append("\n")
+        sys.stdout.write(''.join(out))
 
     printHeader("Memory not released")
     for key, value in mallocs.items():
-        if len(value) > 0 and value[0] != '*':
-            print("   Address     Size")
-            print("{0} {1}".format(key, value))
-            print("\nbacktrace:\n{0}\n".format(membt[key]))
+        if value >= 0:
+            sys.stdout.write(f"   Address     Size\n{key} {value}\n"
+                    f"\nbacktrace:\n{readable_backtrace(membt[key])}\n\n")
 
 if __name__ == '__main__':
-    parse()
-    summary()
+    # Fully buffered output, the report can be very long
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8',
+            write_through=False, line_buffering=False)
+    parser = argparse.ArgumentParser(description='Summarize the output of libmtrace')
+    parser.add_argument('--streaming', action='store_true',
+            help='write one record per event instead of keeping the backtraces '
+                 'in memory, symbols are not demangled')
+    parser.add_argument('files', nargs='*', default=['-'],
+            help="trace files, '-' for stdin (default)")
+    args = parser.parse_args()
+
+    parse(args.files, args.streaming)
+    if not args.streaming:
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            summary(start_resolve_all(executor))
+    sys.stdout.flush()